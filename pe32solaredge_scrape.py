@@ -33,12 +33,16 @@
 #     $ python3 pe32solaredge_scrape.py
 #     {'currentPower': 306.36063,
 #      'lastDayEnergy': 1446.0,
-#      'lastUpdateTime': datetime.datetime(2022, 2, 6, 14, 33, tzinfo=<UTC>),
+#      'lastUpdateTime': datetime.datetime(2022, 2, 6, 14, 33,
+#                                          tzinfo=datetime.timezone.utc),
 #      'lifeTimeEnergy': 4352049.0}
 #
 #     $ python3 pe32solaredge_scrape.py insert
 #     (inserts into db)
 #
+#     $ python3 pe32solaredge_scrape.py insert --loop
+#     (inserts into db every minute, keeping the db connection open)
+#
 # This is work in progress.
 # """
 import base64
@@ -47,48 +51,78 @@ import logging
 import os
 import sys
 import time
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import lru_cache
 
-import requests
-import yaml
+# Heavier third party modules (requests, yaml, psycopg2) are imported in
+# the functions that need them, to keep startup fast for cron runs.
 
 try:
-    # python3-pytz on Ubuntu
-    import pytz
-    TZINFO = pytz.timezone('Europe/Amsterdam')
+    # stdlib zoneinfo on Python 3.9+
+    from zoneinfo import ZoneInfo
+    TZINFO = ZoneInfo('Europe/Amsterdam')
 
     def dt_naive_to_local(naive_dt):
-        try:
-            return TZINFO.localize(naive_dt, is_dst=None)
-        except pytz.exceptions.AmbiguousTimeError:
-            # Don't care; this is during night time anyway.
-            return TZINFO.localize(naive_dt, is_dst=False)
+        # Ambiguous time resolves to the second (non-DST) occurrence, like
+        # is_dst=False below. Don't care; this is during night time anyway.
+        return naive_dt.replace(tzinfo=TZINFO, fold=1)
 
     def dt_local_to_utc(local_dt):
-        return local_dt.astimezone(pytz.utc)
+        return local_dt.astimezone(timezone.utc)
 
     def dt_unixtime(timeobj):
         return int(timeobj.timestamp())
-except ImportError:
-    # python3-arrow on Raspbian
-    import arrow
-    from dateutil.tz import gettz
-    TZFILE = gettz('Europe/Amsterdam')
 
-    def dt_naive_to_local(naive_dt):
-        # XXX: what about ambiguous time?
-        return arrow.get(naive_dt, TZFILE)
+    def dt_datetime(timeobj):
+        return timeobj
+except (ImportError, KeyError):  # KeyError: no tzdata available
+    try:
+        # python3-pytz on Ubuntu
+        import pytz
+        TZINFO = pytz.timezone('Europe/Amsterdam')
 
-    def dt_local_to_utc(local_dt):
-        return local_dt.to('UTC')
+        def dt_naive_to_local(naive_dt):
+            try:
+                return TZINFO.localize(naive_dt, is_dst=None)
+            except pytz.exceptions.AmbiguousTimeError:
+                # Don't care; this is during night time anyway.
+                return TZINFO.localize(naive_dt, is_dst=False)
 
-    def dt_unixtime(timeobj):
-        return timeobj.timestamp
+        def dt_local_to_utc(local_dt):
+            return local_dt.astimezone(pytz.utc)
+
+        def dt_unixtime(timeobj):
+            return int(timeobj.timestamp())
+
+        def dt_datetime(timeobj):
+            return timeobj
+    except ImportError:
+        # python3-arrow on Raspbian
+        import arrow
+        from dateutil.tz import gettz
+        TZFILE = gettz('Europe/Amsterdam')
+
+        def dt_naive_to_local(naive_dt):
+            # XXX: what about ambiguous time?
+            return arrow.get(naive_dt, TZFILE)
+
+        def dt_local_to_utc(local_dt):
+            return local_dt.to('UTC')
+
+        def dt_unixtime(timeobj):
+            return timeobj.timestamp
+
+        def dt_datetime(timeobj):
+            return timeobj.datetime
 
 try:
-    import psycopg2
+    # orjson is a lot faster, and takes/produces bytes directly
+    from orjson import dumps as json_dumpb, loads as json_loads
 except ImportError:
-    pass
+    def json_dumpb(obj):
+        # Compact, like orjson, so the output does not depend on it.
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    json_loads = json.loads
 
 log = logging.getLogger()
 
@@ -110,11 +144,22 @@ if os.environ.get('SOLAREDGE_SCRAPE_RUNDIR'):
 # cookies.json, for temporary cookie storage
 COOKIE_JAR = os.path.join(SPOOLDIR, 'cookies.json')
 
+# api_v3_site.validators.json, ETag/Last-Modified of the cached response
+CACHE_VALIDATORS = os.path.join(SPOOLDIR, 'api_v3_site.validators.json')
+
+# (connect, read) timeout for the SolarEdge fetch, so a stalled server
+# cannot hang the --publish loop indefinitely.
+FETCH_TIMEOUT = (10, 30)
 
+
+@lru_cache(maxsize=1)
 def load_config_yaml():
     """
     Load config.yaml.
 
+    The result is cached for the lifetime of the process; restart to
+    pick up config changes.
+
     For SolarEdge monitoring login, it requires:
 
       solaredge_web:
@@ -135,10 +180,14 @@ def load_config_yaml():
           dbname: database
           password: BASE64_ENCODED_PASSWORD
     """
+    import yaml
+
     config = {}
     try:
         with open(CONFIG) as fp:
-            config = yaml.safe_load(fp.read())
+            # Prefer the libyaml-backed loader if available; same semantics.
+            loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+            config = yaml.load(fp, Loader=loader)
 
         # Mandatory.
         assert config.get('solaredge_web', {}).get('api_v3_site_url')
@@ -167,8 +216,23 @@ def load_config_yaml():
     return config
 
 
+# Shared session, so the keep-alive connection to SolarEdge is reused
+# between fetches in the --publish loop.
+_SESSION = None
+# Last cookie jar contents written to (or read from) COOKIE_JAR.
+_STORED_JAR = None
+
+
 def restore_session():
+    global _SESSION, _STORED_JAR
+    if _SESSION is not None:
+        return _SESSION
+
+    import requests
+    from requests.adapters import HTTPAdapter
+
     sess = requests.Session()
+    sess.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
     try:
         with open(COOKIE_JAR) as fp:
             jar = json.load(fp)
@@ -176,17 +240,39 @@ def restore_session():
         pass
     else:
         sess.cookies = requests.cookies.cookiejar_from_dict(jar)
+        _STORED_JAR = jar
+    _SESSION = sess
     return sess
 
 
 def store_session(sess):
+    global _STORED_JAR
+    import requests
+
     jar = requests.utils.dict_from_cookiejar(sess.cookies)
+    if jar == _STORED_JAR:
+        return  # unchanged, no need to rewrite
     with open(COOKIE_JAR, 'w') as fp:
         json.dump(jar, fp)
         fp.write('\n')
+    _STORED_JAR = jar
+
+
+def load_cache_validators():
+    try:
+        with open(CACHE_VALIDATORS) as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def store_cache_validators(validators):
+    with open(CACHE_VALIDATORS, 'w') as fp:
+        json.dump(validators, fp)
+        fp.write('\n')
 
 
-def parse_api_v3_js(text):
+def parse_api_v3_js(data):
     """
     {
       "siteClassType": "DEFAULT",
@@ -211,13 +297,15 @@ def parse_api_v3_js(text):
             "unit": "W"
             ...
     """
-    js = json.loads(text)
+    js = json_loads(data)
     fo = js['fieldOverview']['fieldOverview']
     ret = {}
     ret['lastUpdateTime'] = fo['lastUpdateTime']
     ret['lastUpdateTime'] = ret['lastUpdateTime'].split('.', 1)[0]
     assert len(ret['lastUpdateTime']) == 19, ret
-    naive_dt = datetime.strptime(ret['lastUpdateTime'], '%Y-%m-%d %H:%M:%S')
+    # Fixed-width 'YYYY-MM-DD HH:MM:SS'; fromisoformat is much cheaper
+    # than strptime (and accepts the space separator).
+    naive_dt = datetime.fromisoformat(ret['lastUpdateTime'])
     local_dt = dt_naive_to_local(naive_dt)
     utc_dt = dt_local_to_utc(local_dt)
     ret['lastUpdateTime'] = utc_dt
@@ -228,7 +316,27 @@ def parse_api_v3_js(text):
     return ret
 
 
-def fetch_api_v3_site():
+# Last (data, parsed) pair, so unchanged data is not parsed again.
+_PARSED_CACHE = (None, None)
+
+
+def parse_cached_api_v3_js(data):
+    global _PARSED_CACHE
+    if data != _PARSED_CACHE[0]:
+        _PARSED_CACHE = (data, parse_api_v3_js(data))
+    return _PARSED_CACHE[1]
+
+
+def fetch_api_v3_site(validators=None):
+    """
+    Fetch api v3 site json; returns (data, validators).
+
+    The validators are the conditional request headers (If-None-Match,
+    If-Modified-Since) for the returned data. If validators are passed
+    and the server says nothing changed (304), data is None.
+    """
+    import requests
+
     web = load_config_yaml()['solaredge_web']
     sess = restore_session()
     if not sess.cookies:
@@ -246,28 +354,43 @@ def fetch_api_v3_site():
     if web['http_referer']:
         headers['Referer'] = web['http_referer']
 
-    resp = sess.get(web['api_v3_site_url'], headers=headers)
+    resp = sess.get(
+        web['api_v3_site_url'], headers={**headers, **(validators or {})},
+        timeout=FETCH_TIMEOUT)
+    if resp.status_code == 304 and validators:
+        store_session(sess)
+        return None, validators
+    # Check the raw bytes; no need to decode the body.
     if (resp.status_code != 200
-            or 'currentPower' not in resp.text):
+            or b'currentPower' not in resp.content):
         sess.cookies.clear()  # wipe stale cookies
         # reset.
         sess.cookies = requests.cookies.cookiejar_from_dict(web['cookies'])
         # retry once.
-        resp2 = sess.get(web['api_v3_site_url'], headers=headers)
+        resp2 = sess.get(
+            web['api_v3_site_url'], headers=headers, timeout=FETCH_TIMEOUT)
         if (resp2.status_code != 200
-                or 'currentPower' not in resp.text):
+                or b'currentPower' not in resp2.content):
             raise ValueError((resp, resp2, resp.text, resp2.text))
         resp = resp2
     store_session(sess)
-    return resp.text
+
+    validators = {}
+    if resp.headers.get('ETag'):
+        validators['If-None-Match'] = resp.headers['ETag']
+    if resp.headers.get('Last-Modified'):
+        validators['If-Modified-Since'] = resp.headers['Last-Modified']
+    return resp.content, validators
 
 
 def fetch_cached_api_v3_site(clear_cache=False):
     """
-    Return cached api v3 site json.
+    Return cached api v3 site json (as bytes), its age and whether it
+    was freshly fetched.
 
     The clear_cache is a hack so we flush the cache manually, while
-    keeping the caching method internal to this function.
+    keeping the caching method internal to this function. If the server
+    reports the cached copy as unchanged, that copy is reused.
 
       {
         "siteClassType": "DEFAULT",
@@ -283,107 +406,176 @@ def fetch_cached_api_v3_site(clear_cache=False):
     """
     cache_file = os.path.join(SPOOLDIR, 'api_v3_site.js')
     try:
-        if clear_cache:
-            raise FileNotFoundError()  # pretend it wasn't there
-        with open(cache_file) as fp:
-            st = os.fstat(fp.fileno())
+        with open(cache_file, 'rb') as fp:
+            st = os.fstat(fp.fileno())  # needed: the only source of age
             age = (time.time() - st.st_mtime)
-            text = fp.read()
-        if text.lstrip()[0] != '{':
+            data = fp.read()
+        if data[:64].lstrip()[:1] != b'{':
             # Broken cache. Retry immediately.
             raise ValueError()
     except (FileNotFoundError, ValueError):
-        text = fetch_api_v3_site()
-        with open(cache_file, 'w') as fp:
-            fp.write(text)
-        age = 0
-    return text, age
+        data = None
+    else:
+        if not clear_cache:
+            return data, age, False
+
+    # Only ask for changes if we have a usable copy to fall back to.
+    validators = load_cache_validators() if data is not None else None
+    new_data, validators = fetch_api_v3_site(validators)
+    if new_data is None:
+        # Not modified. Touch the cache so its age counts from now.
+        os.utime(cache_file)
+    else:
+        data = new_data
+        # Write to .new and swap, so a crash cannot leave a partial file.
+        with open(cache_file + '.new', 'wb') as fp:
+            fp.write(data)
+        os.replace(cache_file + '.new', cache_file)
+        store_cache_validators(validators)
+    return data, 0, True
 
 
 def fetch_reasonably_fresh_data():
     # Get recent copy first.
-    text, age = fetch_cached_api_v3_site(clear_cache=False)
-    parsed = parse_api_v3_js(text)
+    data, age, fetched = fetch_cached_api_v3_site(clear_cache=False)
+    parsed = parse_cached_api_v3_js(data)
+    if fetched:
+        # Cache was missing/broken, so this is fresh already.
+        return parsed, True
     # While current power is 0, only query every 15 minutes.
     if parsed['currentPower'] == 0 and age < (15 * 60):
         return parsed, False
 
-    text, age = fetch_cached_api_v3_site(clear_cache=True)
-    parsed = parse_api_v3_js(text)
+    data, age, fetched = fetch_cached_api_v3_site(clear_cache=True)
+    parsed = parse_cached_api_v3_js(data)
     return parsed, True
 
 
-def insert_latest_into_db():
+def insert_latest_into_db(conn=None):
     """
     Run every minute.
-    """
-    def execute_or_ignore(c, q):
-        try:
-            with conn:
-                with conn.cursor() as cursor:
-                    cursor.execute(query)
-        except psycopg2.IntegrityError:
-            pass
 
+    Pass conn to reuse an existing database connection; otherwise a new
+    one is opened.
+    """
     parsed, fresh = fetch_reasonably_fresh_data()
     if not fresh:
-        exit()
+        return
 
-    config = load_config_yaml()
-    conn = psycopg2.connect(**config['database']['dsn'])
+    # Only now load psycopg2; most cron runs return above.
+    if conn is None:
+        import psycopg2
+        config = load_config_yaml()
+        conn = psycopg2.connect(**config['database']['dsn'])
+
+    insert_parsed_into_db(conn, parsed)
+
+
+def insert_parsed_into_db(conn, parsed):
+    from psycopg2.extras import execute_values
 
     # with conn.cursor() as cursor:
     #     cursor.execute('SELECT NOW();');
     #     now = cursor.fetchall()[0][0]
     # dt = now
 
-    dt = parsed['lastUpdateTime'].strftime('%Y-%m-%d %H:%M:%S')
+    dt = dt_datetime(parsed['lastUpdateTime'])
     table_loc_vals = (
         # ('power', 14, parsed['currentPower']),
         # ('power_kwh', 14, parsed['lifeTimeEnergy'] / 1000.0),
         ('power_kwh', 15, parsed['lastDayEnergy'] / 1000.0),
     )
+    table_rows = {}
     for table, label_id, value in table_loc_vals:
-        query = (
-            f"INSERT INTO {table} (time, location_id, value) VALUES "
-            f"('{dt}'::timestamptz, {label_id}, {value});")
-        execute_or_ignore(conn, query)
+        table_rows.setdefault(table, []).append((dt, label_id, value))
+
+    # One transaction, one multi-row INSERT per table. Rows we already
+    # have are silently skipped.
+    with conn:
+        with conn.cursor() as cursor:
+            for table, rows in table_rows.items():
+                execute_values(
+                    cursor,
+                    f'INSERT INTO {table} (time, location_id, value) '
+                    f'VALUES %s ON CONFLICT DO NOTHING',
+                    rows)
+
+
+def insert_loop():
+    """
+    Like insert_latest_into_db, but keep running, so a single database
+    connection (and HTTP session) is reused between inserts.
+    """
+    import psycopg2
+
+    config = load_config_yaml()
+    conn = None
+    pending = []  # fresh data not inserted yet
+    while True:
+        # A failed fetch should not end the loop; try again next minute.
+        try:
+            parsed, fresh = fetch_reasonably_fresh_data()
+        except Exception:
+            log.exception('Fetch problem; will retry')
+        else:
+            if fresh:
+                pending.append(parsed)
+
+        # Keep data that failed to insert, so a database hiccup does not
+        # lose it (at night, the next fresh data is 15 minutes away).
+        try:
+            while pending:
+                if conn is None:
+                    conn = psycopg2.connect(**config['database']['dsn'])
+                insert_parsed_into_db(conn, pending[0])
+                pending.pop(0)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            log.exception('Database connection problem; will reconnect')
+            if conn is not None:
+                conn.close()
+                conn = None
+        time.sleep(60)
 
 
 def fetch_and_publish():
+    latest_json = os.path.join(SPOOLDIR, 'latest.json')
+    last_payload = None
     while True:
         parsed, fresh = fetch_reasonably_fresh_data()
         if fresh:
-            latest_json = os.path.join(SPOOLDIR, 'latest.json')
-            with open(latest_json + '.new', 'w') as fp:
-                fp.write(json.dumps({
-                    'inst_solar_pwr': parsed['currentPower'],
-                    'solar_act': parsed['lifeTimeEnergy'],
-                    'solar_act_day': parsed['lastDayEnergy'],
-                    'last_update': dt_unixtime(parsed['lastUpdateTime']),
-                }) + '\n')
-            os.rename(latest_json + '.new', latest_json)
-
-            with open(latest_json) as fp:
-                log.info('WROTE latest.json: %r', fp.read())
-
-            # XXX: publish
-            log.warning(
-                'FIXME: publish not implemented yet. Data in %r',
-                latest_json)
+            payload = json_dumpb({
+                'inst_solar_pwr': parsed['currentPower'],
+                'solar_act': parsed['lifeTimeEnergy'],
+                'solar_act_day': parsed['lastDayEnergy'],
+                'last_update': dt_unixtime(parsed['lastUpdateTime']),
+            }) + b'\n'
+            if payload != last_payload:
+                with open(latest_json + '.new', 'wb') as fp:
+                    fp.write(payload)
+                os.rename(latest_json + '.new', latest_json)
+                last_payload = payload
+                log.info('WROTE latest.json: %r', payload.decode('utf-8'))
+
+                # XXX: publish
+                log.warning(
+                    'FIXME: publish not implemented yet. Data in %r',
+                    latest_json)
+            else:
+                log.info('UNCHANGED latest.json')
         log.info('SLEEPING for 400')
         time.sleep(400)
 
 
 def main():
     from pprint import pprint
-    text, ago = fetch_cached_api_v3_site()
-    # print(text)
-    parsed = parse_api_v3_js(text)
+    data, ago, fetched = fetch_cached_api_v3_site()
+    # print(data.decode('utf-8'))
+    parsed = parse_api_v3_js(data)
     pprint(parsed)
     # {'currentPower': 588.72595,
     #  'lastDayEnergy': 1277.0,
-    #  'lastUpdateTime': datetime.datetime(2022, 2, 6, 14, 8, tzinfo=<UTC>),
+    #  'lastUpdateTime': datetime.datetime(2022, 2, 6, 14, 8,
+    #                                      tzinfo=datetime.timezone.utc),
     #  'lifeTimeEnergy': 4351880.0}
 
 
@@ -412,5 +604,7 @@ if __name__ == '__main__':
         fetch_and_publish()
     elif sys.argv[1:] == ['insert']:
         insert_latest_into_db()
+    elif sys.argv[1:] == ['insert', '--loop']:
+        insert_loop()
     else:
         assert False